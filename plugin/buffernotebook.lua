@@ -0,0 +1,53 @@
+-- Edits are debounced here, on the editor's side, so that individual keystrokes never have to
+-- travel to the python remote plugin; only once a buffer has settled is it evaluated
+
+local delay = 300 -- ms
+local timers = {}
+
+local function close_popup(bufnr)
+  local popup = vim.b[bufnr].buffernotebook_popup
+  if popup ~= nil and vim.api.nvim_win_is_valid(popup) then
+    vim.api.nvim_win_close(popup, true)
+  end
+end
+
+local group = vim.api.nvim_create_augroup("BufferNotebook", { clear = true })
+
+vim.api.nvim_create_autocmd({ "TextChanged", "TextChangedI" }, {
+  group = group,
+  callback = function(args)
+    local bufnr = args.buf
+    if not vim.b[bufnr].buffernotebook_enabled then
+      return
+    end
+    close_popup(bufnr)
+
+    local timer = timers[bufnr]
+    if timer == nil then
+      timer = (vim.uv or vim.loop).new_timer()
+      timers[bufnr] = timer
+    end
+    timer:stop()
+    timer:start(
+      delay,
+      0,
+      vim.schedule_wrap(function()
+        if vim.api.nvim_buf_is_valid(bufnr) and vim.b[bufnr].buffernotebook_enabled then
+          vim.fn.BufferNotebookEvaluate(bufnr)
+        end
+      end)
+    )
+  end,
+})
+
+vim.api.nvim_create_autocmd("BufDelete", {
+  group = group,
+  callback = function(args)
+    local timer = timers[args.buf]
+    if timer ~= nil then
+      timer:stop()
+      timer:close()
+      timers[args.buf] = nil
+    end
+  end,
+})
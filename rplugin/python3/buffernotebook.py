@@ -1,8 +1,12 @@
 import ast
-import functools
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import itertools
 import pprint
 import re
-import threading
+import types
 from dataclasses import dataclass
 from typing import Any, Callable, Optional
 
@@ -25,7 +29,7 @@ import pynvim.api
 
 @dataclass
 class Timer:
-    """Timer utility, is initialized with a callback.
+    """Timer utility, is initialized with a callback and the event loop to schedule it on.
 
     - Responds to events by invoking a delay
     - Every time an event arrives, a timer starts
@@ -54,22 +58,34 @@ class Timer:
 
         event -> timer_start -> timer_finish -> callback_start -> event -> new_timer_start
             -> new_timer_finish -> callback_finish -> new_callback_start -> new_callback_finish
+
+    Timers are scheduled with `loop.call_later` (for the plugin, the loop pynvim already runs on),
+    so no thread is created per event. `event` must be called from the loop's thread. The last two
+    scenarios only apply to callbacks that yield back to the loop while running.
     """
 
     callback: Callable[[], None]
+    loop: asyncio.AbstractEventLoop
     delay: float = 0.3
-    _timer: threading.Timer | None = None
+    _handle: asyncio.TimerHandle | None = None
     _is_executing: bool = False
     _execute_on_finish: bool = False
 
     def event(self):
-        if self._timer is not None:
-            self._timer.cancel()
-        self._timer = threading.Timer(self.delay, self._on_timeout)
-        self._timer.start()
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self.loop.call_later(self.delay, self._on_timeout)
+
+    def cancel(self):
+        """Drop the pending timer, if any, so that the callback does not run for past events."""
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._execute_on_finish = False
 
     def _on_timeout(self):
-        self._timer = None
+        self._handle = None
         if self._is_executing:
             self._execute_on_finish = True
         else:
@@ -83,6 +99,30 @@ class Timer:
 
 nothing_to_show = object()
 
+# Inline (`a  #=`) and full-line (`a  # <<<`) marks; a line has a mark if it ends with `#`, then
+# `=` or `<<<`, with optional whitespace around them. Also matches every marked line of the whole
+# buffer at once, with the lines joined with newlines
+_MARKS_RE = re.compile(r"#[^\S\n]*(?:=|<<<)[^\S\n]*$", re.MULTILINE)
+
+# How many compiled statements to keep around
+_CODE_CACHE_SIZE = 512
+
+# Containers with more items than this are truncated in popups and injected results
+_MAX_FORMATTED_ITEMS = 200
+
+# Formatters for the most common (exact) types of results, that need neither `isinstance` checks
+# nor `pprint`
+_FORMATTERS: dict[type, Callable[[Any], str]] = {
+    str: str,
+    int: repr,
+    float: repr,
+    bool: repr,
+    type(None): repr,
+}
+
+# Strings and containers longer than this are annotated with just their type and length
+_MAX_ANNOTATED_ITEMS = 10_000
+
 
 class BufferNotebook:
     def __init__(self, nvim: pynvim.Nvim, buffer: pynvim.api.Buffer):
@@ -93,23 +133,86 @@ class BufferNotebook:
         self._namespace = self._nvim.api.create_namespace("BufferNotebookNamepsace")
 
         self._globals: dict = {"__name__": "__main__"}
-        self._cache: list[tuple[str, Any]] = []
+        self._cache: list[tuple[tuple, Any, Optional[int]]] = []
+        # Keyed by the hash of the fingerprint, which is cheap to look up; the fingerprint itself is
+        # kept next to the code to rule out hash collisions, and the line the statement was compiled
+        # at so that the code can be moved along with the statement
+        self._code_cache: collections.OrderedDict[
+            int, tuple[tuple, int, types.CodeType]
+        ] = collections.OrderedDict()
+        self._parse_key: Optional[tuple[int, int]] = None
+        self._parse_tree = ast.Module(body=[], type_ignores=[])
+        self._parse_lines: tuple[str, ...] = ()
+        self._parse_removed: list[int] = []
+        self._statement_starts: tuple[Optional[ast.Module], list[int]] = (None, [])
+
+        # The parse tree whose first `_evaluated_count` statements are reflected in `_cache`
+        self._evaluated_tree: Optional[ast.Module] = None
+        self._evaluated_count = 0
+        # Fingerprints and start lines of the statements, plus the marks, behind `_annotations`
+        self._annotated_state: Optional[tuple[list, list[int], list[int]]] = None
+        self._annotations: list[tuple[int, str]] = []
         self._popup_window = None
-
-        self._timer = Timer(lambda: self._nvim.async_call(self._evaluate_and_annotate))
+        self._popup_buffer = None
+        self._popup_future: Optional[concurrent.futures.Future] = None
+
+        # The user's code runs on this (single) worker thread, so that a slow statement does not
+        # block the plugin; everything that touches the evaluation state goes through it
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._future: Optional[concurrent.futures.Future] = None
+        # Bumped whenever the running evaluation (if any) becomes pointless; it checks this between
+        # statements and gives up
+        self._generation = 0
+        # Key of the lines that were last sent to be evaluated and annotated
+        self._annotated_key: Optional[tuple[int, int]] = None
+
+        # Local copy of the buffer, kept up to date with `nvim_buf_attach` events while enabled
+        self._lines: Optional[list[str]] = None
+        # Tuple copy of `_lines`, made at most once per change; as long as the buffer does not
+        # change, everything downstream (eg `_parse`) gets the very same object
+        self._snapshot: Optional[tuple[str, ...]] = None
+
+        # Edits are debounced on the editor's side (`plugin/buffernotebook.lua`); cursor moves are
+        # debounced here. The callback still goes through `async_call`: a plain loop callback
+        # cannot make (blocking) requests to neovim, only handlers running in pynvim's greenlets can
+        self._cursor_timer = Timer(
+            lambda: self._nvim.async_call(self._open_popup), self._nvim.loop, delay=0.05
+        )
 
     def enable(self):
         self._enabled = True
+        self._nvim.api.buf_set_var(self._buffer, "buffernotebook_enabled", True)
         self.on_change()
-        self.on_cursor_moved()
+        self._open_popup()
         self._nvim.out_write("BufferNotebook enabled\n")
 
     def disable(self):
         self._enabled = False
+        self._nvim.api.buf_set_var(self._buffer, "buffernotebook_enabled", False)
+        self._generation += 1
+        self._annotated_key = None
+        self._cursor_timer.cancel()
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
         self._clear()
         self._remove_popup()
+        self._delete_popup_buffer()
+        if self._lines is not None:
+            self._nvim.api.buf_detach(self._buffer)
+            self._lines = self._snapshot = None
         self._nvim.out_write("BufferNotebook disabled\n")
 
+    def close(self):
+        """Let go of everything the notebook holds on to, once its buffer is deleted."""
+
+        self._generation += 1
+        self._future = self._popup_future = None
+        self._cursor_timer.cancel()
+        self._remove_popup()
+        self._delete_popup_buffer()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
     def toggle(self):
         if self._enabled:
             self.disable()
@@ -145,44 +248,88 @@ class BufferNotebook:
             self._nvim.funcs.setreg("+", repr(result))
 
     def reset(self):
+        self._executor.submit(self._reset)
+        self._annotated_key = None
+        self._evaluate_and_annotate()
+
+    def _reset(self):
         self._globals = {"__name__": "__main__"}
         self._cache = []
-        self._evaluate_and_annotate()
+        self._evaluated_tree = None
+        self._annotated_state = None
 
     def on_change(self):
+        """Called once edits to the buffer have settled."""
+
         if not self._enabled:
             return
         self._remove_popup()
-        self._timer.event()
+        self._evaluate_and_annotate()
+
+    def on_lines(self, firstline: int, lastline: int, linedata: list[str]):
+        if self._lines is not None:
+            self._lines[firstline:lastline] = linedata
+            self._snapshot = None
+
+    def on_detach(self):
+        self._lines = self._snapshot = None
 
     def on_cursor_moved(self):
+        # Closing the popup is cheap and should feel immediate; opening a new one waits until the
+        # cursor settles
         self._remove_popup()
+        if self._enabled:
+            self._cursor_timer.event()
 
+    def _open_popup(self):
         if not self._enabled:
             return
 
-        lines = tuple(self._nvim.api.buf_get_lines(self._buffer, 0, -1, False))
-        current_line_position, currenct_cursor_position = self._nvim.api.win_get_cursor(
-            0
+        lines, (current_line_position, currenct_cursor_position) = (
+            self._get_lines_and_cursor()
         )
         current_line_position -= 1
 
         if not self._has_mark(lines[current_line_position]):
             return
 
-        result, _ = self._evaluate_statement_under_cursor()
+        # Both evaluating and pretty-printing can take a while, so they happen on the worker
+        # thread and the popup is opened once they are done
+        future = self._executor.submit(self._popup_lines, lines, current_line_position)
+        self._popup_future = future
+        future.add_done_callback(
+            lambda future: self._nvim.async_call(
+                self._show_popup, future, currenct_cursor_position
+            )
+        )
+
+    def _popup_lines(
+        self, lines: tuple[str, ...], current_line_position: int
+    ) -> list[str]:
+        result, _ = self._evaluate_until(lines, current_line_position)
         if result is nothing_to_show:
+            return []
+        return self._format_multiline_result(result).splitlines()
+
+    def _show_popup(
+        self, future: concurrent.futures.Future, currenct_cursor_position: int
+    ):
+        if future is not self._popup_future:
+            return  # The cursor has moved (or the buffer changed) in the meantime
+        self._popup_future = None
+
+        popup_lines = future.result()
+        height = len(popup_lines)
+        if height <= 1:
             return
-        result = self._format_multiline_result(result)
-        if "\n" not in result:
-            return
+        width = max(map(len, popup_lines))
 
-        popup_buffer = self._nvim.api.create_buf(False, True)
-        self._nvim.api.buf_set_lines(popup_buffer, 0, -1, False, result.splitlines())
-        width = max(len(line) for line in result.splitlines())
-        height = len(result.splitlines())
+        # One scratch buffer is reused for all popups instead of leaving a new one behind every time
+        if self._popup_buffer is None:
+            self._popup_buffer = self._nvim.api.create_buf(False, True)
+        self._nvim.api.buf_set_lines(self._popup_buffer, 0, -1, False, popup_lines)
         self._popup_window = self._nvim.api.open_win(
-            popup_buffer,
+            self._popup_buffer,
             False,
             {
                 "relative": "cursor",
@@ -195,216 +342,602 @@ class BufferNotebook:
             },
         )
         self._nvim.api.win_set_option(self._popup_window, "foldenable", False)
+        # So that the popup can be closed as soon as the buffer is edited, without waiting for
+        # the (debounced) evaluation
+        self._nvim.api.buf_set_var(
+            self._buffer, "buffernotebook_popup", self._popup_window.handle
+        )
 
     def _clear(self):
         self._nvim.api.buf_clear_namespace(self._buffer, self._namespace, 0, -1)
 
-    @functools.lru_cache
     def _parse(self, lines: tuple[str, ...]) -> ast.Module:
-        return ast.parse("\n".join(self._remove_unparseable_lines(lines)))
+        """Parse the buffer, reusing the statements of the previous parse that lie outside the
+        lines that changed since then. Only the changed region (plus the statements right next to
+        it) is passed through `_remove_unparseable_lines` and `ast.parse` again.
+        """
+
+        # Single-slot cache: the common case is parsing the same, unchanged buffer again (usually
+        # the same snapshot, which does not even need hashing)
+        if lines is self._parse_lines:
+            return self._parse_tree
+        key = (len(lines), hash(lines))
+        if key == self._parse_key:
+            return self._parse_tree
+
+        old_lines, old_body = self._parse_lines, self._parse_tree.body
+
+        # Lines that are the same at the start and at the end of the buffer
+        limit = min(len(lines), len(old_lines))
+        prefix = 0
+        while prefix < limit and lines[prefix] == old_lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and lines[-suffix - 1] == old_lines[-suffix - 1]:
+            suffix += 1
+
+        # Lines that were removed last time may become parse-able because of the edit, so they
+        # are part of the region to parse again
+        dirty_start = min([prefix] + self._parse_removed)
+        dirty_end = max(
+            [len(old_lines) - suffix] + [i + 1 for i in self._parse_removed]
+        )
+
+        # Keep the statements before and after the dirty region, except for the ones right next to
+        # it; the edit may extend them (eg with an `else:` block or a decorator). Statements that
+        # share a line (`a = 1; b = 2`) are kept or dropped together.
+        head = max(sum(1 for s in old_body if self._end_line(s) <= dirty_start) - 1, 0)
+        while head and self._end_line(old_body[head - 1]) > self._start_line(
+            old_body[head]
+        ):
+            head -= 1
+        tail = next(
+            (i for i, s in enumerate(old_body) if self._start_line(s) >= dirty_end),
+            len(old_body),
+        )
+        tail = min(tail + 1, len(old_body))
+        while tail < len(old_body) and self._start_line(
+            old_body[tail]
+        ) < self._end_line(old_body[tail - 1]):
+            tail += 1
+
+        offset = len(lines) - len(old_lines)
+        start = self._end_line(old_body[head - 1]) if head else 0
+        end = (
+            self._start_line(old_body[tail]) + offset
+            if tail < len(old_body)
+            else len(lines)
+        )
+
+        middle_lines = cleaned = lines[start:end]
+        try:
+            middle = ast.parse("\n".join(middle_lines))
+        except Exception:
+            # Removing lines is not local: the lines that do parse may reach into the statements
+            # after the edit (eg through a string literal), so those cannot be reused
+            tail = len(old_body)
+            middle_lines = lines[start:]
+            cleaned = self._remove_unparseable_lines(middle_lines)
+            middle = ast.parse("\n".join(cleaned))
+        ast.increment_lineno(middle, start)
+        for statement in old_body[tail:]:
+            ast.increment_lineno(statement, offset)
+
+        self._parse_tree = ast.Module(
+            body=old_body[:head] + middle.body + old_body[tail:], type_ignores=[]
+        )
+        self._parse_key = key
+        self._parse_lines = lines
+        self._parse_removed = [
+            start + i
+            for i, (line, cleaned_line) in enumerate(zip(middle_lines, cleaned))
+            if line != cleaned_line
+        ]
+        return self._parse_tree
+
+    @staticmethod
+    def _start_line(statement: ast.stmt) -> int:
+        """0-based line where a statement starts, including its decorators."""
+
+        decorators = getattr(statement, "decorator_list", [])
+        return min([statement.lineno] + [d.lineno for d in decorators]) - 1
+
+    @staticmethod
+    def _end_line(statement: ast.stmt) -> int:
+        """0-based line right after a statement ends."""
+
+        return statement.end_lineno or statement.lineno
 
     @staticmethod
     def _remove_unparseable_lines(lines: tuple[str, ...]) -> tuple[str, ...]:
         """Assuming most lines are ok, try to replacing as few lines as possible with empty ones so
         that the end result is parse-able.
-        """
 
-        if not lines:
-            return ()  # Recursion exit
+        Instead of bisecting via repeated parses, let the parser point at the offending line: the
+        longest parse-able prefix always ends before the line the `SyntaxError` is reported on.
+        """
 
-        end = len(lines)
-        while end > 0:
+        result: list[str] = []
+        start = 0
+        while start < len(lines):
             try:
+                ast.parse("\n".join(lines[start:]))
+            except Exception as exc:
                 # Bad:  [ G   G   G   B   G   G ]
-                # Bad:  [ G   G   G   B   G ] G
-                # Bad:  [ G   G   G   B ] G   G
-                # Good: [ G   G   G ] B   G   G
-                ast.parse("\n".join(lines[:end]))
-            except Exception:
-                end -= 1
+                #                     ^ exc.lineno
+                lineno = getattr(exc, "lineno", None) or len(lines) - start
+                end = min(start + lineno - 1, len(lines) - 1)
             else:
-                # Good:   [G G G]                              B G G
-                # Return: [G G G] + _remove_unparseable_lines([B G G])
-                return lines[:end] + BufferNotebook._remove_unparseable_lines(
-                    lines[end:]
-                )
+                result.extend(lines[start:])
+                break
 
-        # Ended the for-loop without encountering a good chunk; (at least) first line must be bad
-        #          B                                B                                G G ...
-        # Return: [""] + _remove_unparseable_lines([B                                G G ...])
-        # Return: [""] +                           [""] + _remove_unparseable_lines([G G ...])
-        return ("",) + BufferNotebook._remove_unparseable_lines(lines[1:])
+            while end > start:
+                try:
+                    # Bad:  [ G   G   G ] B   G   G  (rarely, eg "Perhaps you forgot a comma?")
+                    # Good: [ G   G ] G   B   G   G
+                    ast.parse("\n".join(lines[start:end]))
+                except Exception:
+                    end -= 1
+                else:
+                    break
+
+            # Good:   [G G G]   B   G G
+            # Result: [G G G] + [""] + (continue with [G G])
+            result.extend(lines[start:end])
+            result.append("")
+            start = end + 1
+
+        return tuple(result)
 
     def _evaluate_and_annotate(self):
-        self._clear()
+        lines = self._get_lines()
+
+        # `TextChanged` also fires when the text ends up the same (eg undo followed by redo); the
+        # annotations that are shown (or on their way) are still correct then
+        key = (len(lines), hash(lines))
+        if key == self._annotated_key:
+            return
+        self._annotated_key = key
+
+        if self._future is not None:
+            # Superseded before it even started (cancelling a running one has no effect)
+            self._future.cancel()
+        self._generation += 1
+        future = self._executor.submit(self._evaluate_marks, lines, self._generation)
+        self._future = future
+        future.add_done_callback(
+            lambda future: self._nvim.async_call(self._flush_annotations, future, lines)
+        )
+
+    def _evaluate_marks(
+        self, lines: tuple[str, ...], generation: int
+    ) -> list[tuple[int, str]]:
+        """Runs on the worker thread: evaluate the buffer and return the text of the annotation
+        for each marked line. Gives up as soon as a newer evaluation is requested; the results
+        of the statements evaluated so far are kept in the cache.
+        """
+
+        annotations: list[tuple[int, str]] = []
 
-        lines = tuple(self._nvim.api.buf_get_lines(self._buffer, 0, -1, False))
+        marks = self._find_marks(lines)
+        if not marks:
+            # Nothing to annotate, so nothing to evaluate either; `inject`, `copy` and the popup
+            # evaluate what they need on their own
+            return annotations
+        mark_index = 0
 
+        tree = self._parse(lines)
         top_level_statements: list[tuple[int, ast.stmt]] = [
-            (statement.lineno - 1, statement) for statement in self._parse(lines).body
+            (statement.lineno - 1, statement) for statement in tree.body
         ]
 
-        marks = {index for index, line in enumerate(lines) if self._has_mark(line)}
+        # Edits that change neither the statements nor where they and the marks are (eg trailing
+        # whitespace or comments) lead to the same annotations
+        state = (
+            [self._fingerprint(statement) for statement in tree.body],
+            [start_line_number for start_line_number, _ in top_level_statements],
+            marks,
+        )
+        if state == self._annotated_state:
+            return self._annotations
+
+        # The results of the statements before the first one that changed are in the cache as they
+        # are; reused statements even have the very same fingerprint object
+        unchanged = 0
+        for (cache_key, _, _), fingerprint in zip(self._cache, state[0]):
+            if cache_key is not fingerprint and cache_key != fingerprint:
+                break
+            unchanged += 1
 
         for index, (start_line_number, statement) in enumerate(top_level_statements):
-            result = self._evaluate_statement(index, statement)
+            if index < unchanged:
+                result = self._cache[index][1]
+            elif generation != self._generation:
+                return annotations  # Stale, `_flush_annotations` will ignore it
+            else:
+                result = self._evaluate_statement(index, statement, lines)
 
             try:
                 end, _ = top_level_statements[index + 1]
             except IndexError:
                 end = len(lines)
-            for line_number in set(range(start_line_number, end)) & marks:
-                self._annotate(line_number, result)
 
-    def _evaluate_statement(self, index: int, statement: ast.stmt) -> Any:
-        key = ast.dump(statement)
+            # Both statements and marks are sorted by line number, so sweep them together
+            while mark_index < len(marks) and marks[mark_index] < end:
+                if (
+                    marks[mark_index] >= start_line_number
+                    and result is not nothing_to_show
+                ):
+                    annotations.append((marks[mark_index], self._annotation(result)))
+                mark_index += 1
+
+        self._evaluated_tree, self._evaluated_count = tree, len(tree.body)
+        self._annotated_state, self._annotations = state, annotations
+        return annotations
+
+    @classmethod
+    def _fingerprint(cls, statement: ast.stmt) -> tuple:
+        """Structure of a statement as nested tuples, leaving out positions: statements that only
+        differ in formatting or comments have equal fingerprints. Computed once and kept on the
+        node itself; since `_parse` reuses the nodes of statements that were not edited, this is
+        only recomputed for statements that actually changed.
+        """
+
+        fingerprint = getattr(statement, "_bn_fingerprint", None)
+        if fingerprint is None:
+            fingerprint = cls._structure(statement)
+            setattr(statement, "_bn_fingerprint", fingerprint)
+            setattr(statement, "_bn_fingerprint_hash", hash(fingerprint))
+        return fingerprint
+
+    @classmethod
+    def _fingerprint_hash(cls, statement: ast.stmt) -> int:
+        """`hash` of the fingerprint, kept on the node as well: tuples do not cache their hash, and
+        rehashing a big statement's fingerprint on every lookup would take a while.
+        """
+
+        cls._fingerprint(statement)
+        return getattr(statement, "_bn_fingerprint_hash")
+
+    @classmethod
+    def _structure(cls, node: Any) -> tuple:
+        if isinstance(node, ast.AST):
+            return (type(node),) + tuple(
+                cls._structure(getattr(node, field, None)) for field in node._fields
+            )
+        elif isinstance(node, list):
+            return tuple(cls._structure(item) for item in node)
+        else:
+            # Along with the type, since `1 == 1.0 == True`
+            return (type(node), node)
+
+    def _evaluate_statement(
+        self, index: int, statement: ast.stmt, lines: tuple[str, ...] = ()
+    ) -> Any:
+        signature = self._signature(statement, lines) if lines else None
         try:
-            cache_key, cache_result = self._cache[index]
+            cache_key, cache_result, cache_signature = self._cache[index]
         except IndexError:
             pass
         else:
-            if key == cache_key:
+            # Same source text: no need to compare (or even compute) fingerprints
+            if signature is not None and signature == cache_signature:
+                return cache_result
+            elif self._fingerprint(statement) == cache_key:
+                self._cache[index] = (cache_key, cache_result, signature)
                 return cache_result
             else:
                 self._cache = self._cache[:index]
 
-        if isinstance(statement, ast.Assign):
-            try:
-                self._do_exec(statement)
-            except Exception as exc:
-                result = exc
+        key = self._fingerprint(statement)
 
-            else:
-                if len(statement.targets) != 1:
-                    result = nothing_to_show
+        handler = self._HANDLERS.get(type(statement), BufferNotebook._execute)
+        try:
+            result = handler(self, statement)
+        except Exception as exc:
+            result = exc
 
-                if isinstance(statement.targets[0], ast.Tuple) and all(
-                    isinstance(elt, ast.Name) for elt in statement.targets[0].elts
-                ):
-                    result = []
-                    try:
-                        for elt in statement.targets[0].elts:
-                            assert isinstance(elt, ast.Name)
-                            result.append(self._globals[elt.id])
-                    except KeyError:
-                        result = nothing_to_show
-                    else:
-                        result = tuple(result)
-
-                elif isinstance(statement.targets[0], ast.Name):
-                    try:
-                        result = self._globals[statement.targets[0].id]
-                    except KeyError:
-                        result = nothing_to_show
+        self._cache.append((key, result, signature))
+        return result
 
-                else:
-                    result = nothing_to_show
+    def _execute(self, statement: ast.stmt) -> Any:
+        exec(self._compile(statement), self._globals)
+        return nothing_to_show
+
+    def _evaluate_assign(self, statement: ast.Assign) -> Any:
+        exec(self._compile(statement), self._globals)
+
+        target = statement.targets[0]
+        if isinstance(target, ast.Tuple):
+            result = []
+            for elt in target.elts:
+                if not isinstance(elt, ast.Name) or elt.id not in self._globals:
+                    return nothing_to_show
+                result.append(self._globals[elt.id])
+            return tuple(result)
+        elif isinstance(target, ast.Name):
+            return self._globals.get(target.id, nothing_to_show)
+        else:
+            return nothing_to_show
 
-        elif isinstance(statement, ast.AugAssign) and isinstance(
-            statement.target, ast.Name
-        ):
-            try:
-                self._do_exec(statement)
-            except Exception as exc:
-                result = exc
-            else:
-                try:
-                    result = self._globals[statement.target.id]
-                except KeyError:
-                    result = nothing_to_show
+    def _evaluate_aug_assign(self, statement: ast.AugAssign) -> Any:
+        exec(self._compile(statement), self._globals)
 
-        elif isinstance(statement, ast.Expr):
-            try:
-                result = eval(
-                    compile(ast.Expression(statement.value), "<string>", "eval"),
-                    self._globals,
-                )
+        if isinstance(statement.target, ast.Name):
+            return self._globals.get(statement.target.id, nothing_to_show)
+        else:
+            return nothing_to_show
 
-            except Exception as exc:
-                result = exc
+    def _evaluate_import(self, statement: ast.Import | ast.ImportFrom) -> Any:
+        exec(self._compile(statement), self._globals)
 
-        elif isinstance(statement, (ast.Import, ast.ImportFrom)):
+        result = []
+        for name in statement.names:
             try:
-                self._do_exec(statement)
-            except Exception as exc:
-                result = exc
-            else:
-                try:
-                    result = [
-                        self._globals[name.asname or name.name]
-                        for name in statement.names
-                    ]
-                except KeyError:
-                    result = nothing_to_show
-                else:
-                    if len(result) == 1:
-                        result = result[0]
-                    else:
-                        result = tuple(result)
+                result.append(self._globals[name.asname or name.name])
+            except KeyError:
+                return nothing_to_show
+        return result[0] if len(result) == 1 else tuple(result)
+
+    def _evaluate_expression(self, statement: ast.Expr) -> Any:
+        # "Probe" lines like `a  #=` or `a.b  #=` are very common; resolve literals, names and
+        # attribute chains directly instead of compiling and evaluating them
+        value = statement.value
+        if isinstance(value, ast.Constant):
+            return value.value
+
+        attributes = []
+        while isinstance(value, ast.Attribute):
+            attributes.append(value.attr)
+            value = value.value
+        if isinstance(value, ast.Name) and value.id in self._globals:
+            result = self._globals[value.id]
+            for attribute in reversed(attributes):
+                result = getattr(result, attribute)
+            return result
 
-        else:
-            try:
-                self._do_exec(statement)
-            except Exception as exc:
-                result = exc
-            else:
-                result = nothing_to_show
+        # Everything else, including builtins and undefined names
+        return eval(self._compile(statement), self._globals)
+
+    # How to evaluate each type of statement, and what to show for it; any other statement is only
+    # executed
+    _HANDLERS: dict[type, Callable[["BufferNotebook", Any], Any]] = {
+        ast.Assign: _evaluate_assign,
+        ast.AugAssign: _evaluate_aug_assign,
+        ast.Expr: _evaluate_expression,
+        ast.Import: _evaluate_import,
+        ast.ImportFrom: _evaluate_import,
+    }
+
+    @classmethod
+    def _signature(cls, statement: ast.stmt, lines: tuple[str, ...]) -> int:
+        """Hash of the source text of a statement. If it matches, the statement is the same one as
+        before, wherever it has moved to in the buffer.
+        """
 
-        self._cache.append((key, result))
-        return result
+        return hash(
+            (
+                statement.col_offset,
+                statement.end_col_offset,
+                lines[cls._start_line(statement) : cls._end_line(statement)],
+            )
+        )
+
+    @staticmethod
+    def _find_marks(lines: tuple[str, ...]) -> list[int]:
+        """Line numbers of all the marks, in order. Scanning the whole buffer with one regex keeps
+        the loop over the (usually many more) lines without marks out of Python.
+        """
+
+        source = "\n".join(lines)
+        marks: list[int] = []
+        line_number = position = 0
+        for match in _MARKS_RE.finditer(source):
+            line_number += source.count("\n", position, match.start())
+            position = match.start()
+            marks.append(line_number)
+        return marks
 
     @staticmethod
     def _has_mark(line):
-        return re.search(r"#\s*=\s*$", line) or re.search(r"#\s*<<<\s*$", line)
+        return _MARKS_RE.search(line) is not None
 
-    def _annotate(self, line_number: int, value: Any):
-        if value is nothing_to_show:
-            return
-        elif isinstance(value, Exception):
-            text = f"! {value!r}"
+    @staticmethod
+    def _annotation(value: Any) -> str:
+        if isinstance(value, Exception):
+            return f"! {value!r}"
+        elif (
+            isinstance(value, (str, list, tuple, dict, set, frozenset))
+            and len(value) > _MAX_ANNOTATED_ITEMS
+        ):
+            # Too long to read as a single line of virtual text anyway, and `repr` can be slow
+            return f"<{type(value).__name__} len={len(value)}>"
         else:
-            text = repr(value)
+            return repr(value)
+
+    def _flush_annotations(
+        self, future: concurrent.futures.Future, lines: tuple[str, ...]
+    ):
+        if future is not self._future or future.cancelled():
+            return  # Stale; a newer evaluation is on its way, or the notebook was disabled
+        self._future = None
+
+        # The buffer changed while evaluating, so the annotations may point at the wrong lines (or
+        # past the end of the buffer); the change will trigger a new evaluation anyway
+        current_lines = self._get_lines()
+        if current_lines is not lines and current_lines != lines:
+            return
 
-        self._nvim.api.buf_set_virtual_text(
-            self._buffer, self._namespace, line_number, [(text, "Info")], {}
+        annotations = future.result()
+
+        # Clear the previous annotations and set the new ones in a single RPC round-trip
+        self._call_atomic(
+            [["nvim_buf_clear_namespace", [self._buffer, self._namespace, 0, -1]]]
+            + [
+                [
+                    "nvim_buf_set_extmark",
+                    [
+                        self._buffer,
+                        self._namespace,
+                        line_number,
+                        0,
+                        {"virt_text": [(text, "Info")]},
+                    ],
+                ]
+                for line_number, text in annotations
+            ]
         )
 
     def _evaluate_statement_under_cursor(self) -> tuple[Any, Optional[ast.stmt]]:
         if not self._enabled:
             self.enable()
-        lines = tuple(self._nvim.api.buf_get_lines(self._buffer, 0, -1, False))
-        current_line_position = self._nvim.api.win_get_cursor(0)[0] - 1
+        lines, (current_line_position, _) = self._get_lines_and_cursor()
+        return self._evaluate_statement_at(lines, current_line_position - 1)
+
+    def _evaluate_statement_at(
+        self, lines: tuple[str, ...], current_line_position: int
+    ) -> tuple[Any, Optional[ast.stmt]]:
+        # Wait for the worker thread, after anything that is already queued on it
+        return self._executor.submit(
+            self._evaluate_until, lines, current_line_position
+        ).result()
+
+    def _evaluate_until(
+        self, lines: tuple[str, ...], current_line_position: int
+    ) -> tuple[Any, Optional[ast.stmt]]:
+        tree = self._parse(lines)
+
+        if self._statement_starts[0] is not tree:
+            self._statement_starts = (tree, [s.lineno - 1 for s in tree.body])
+        index = (
+            bisect.bisect_right(self._statement_starts[1], current_line_position) - 1
+        )
+        if index < 0 or current_line_position >= self._end_line(tree.body[index]):
+            return nothing_to_show, None
+
+        # Only evaluate the statements up to this one that have not been evaluated (against this
+        # very parse tree) yet; usually that is none of them
+        if tree is not self._evaluated_tree:
+            self._evaluated_tree, self._evaluated_count = tree, 0
+        for i in range(self._evaluated_count, index + 1):
+            self._evaluate_statement(i, tree.body[i], lines)
+        self._evaluated_count = max(self._evaluated_count, index + 1)
+
+        return self._cache[index][1], tree.body[index]
+
+    def _get_lines(self) -> tuple[str, ...]:
+        if self._lines is not None:
+            if self._snapshot is None:
+                self._snapshot = tuple(self._lines)
+            return self._snapshot
+        if not self._enabled:
+            return tuple(self._nvim.api.buf_get_lines(self._buffer, 0, -1, False))
+
+        # Not attached yet (or detached, eg by `:edit`): seed the local copy and subscribe to
+        # changes in a single atomic call so that no edit can fall in between
+        lines, attached = self._call_atomic(
+            [
+                ["nvim_buf_get_lines", [self._buffer, 0, -1, False]],
+                ["nvim_buf_attach", [self._buffer, False, {}]],
+            ]
+        )
+        lines = tuple(lines)
+        if attached:
+            self._lines, self._snapshot = list(lines), lines
+        return lines
 
-        for index, statement in enumerate(self._parse(lines).body):
-            result = self._evaluate_statement(index, statement)
-            if (
-                statement.lineno - 1
-                <= current_line_position
-                < (statement.end_lineno or statement.lineno)
-            ):
-                return result, statement
+    def _get_lines_and_cursor(self) -> tuple[tuple[str, ...], tuple[int, int]]:
+        line, column = self._nvim.api.win_get_cursor(0)
+        return self._get_lines(), (line, column)
 
-        return nothing_to_show, None
+    def _call_atomic(self, calls: list[list]) -> list:
+        results, error = self._nvim.api.call_atomic(calls)
+        if error is not None:
+            raise pynvim.NvimError(error[2])
+        return results
 
     def _format_multiline_result(self, result: Any):
-        if isinstance(result, Exception):
+        formatter = _FORMATTERS.get(type(result))
+        if formatter is not None:
+            return formatter(result)
+        elif isinstance(result, Exception):
             return f"! {result!r}"
         elif isinstance(result, str):
             return result
+        elif (
+            isinstance(result, (list, tuple, dict, set, frozenset))
+            and len(result) > _MAX_FORMATTED_ITEMS
+        ):
+            # Pretty-printing a huge container can take seconds and blocks neovim
+            if isinstance(result, dict):
+                head: Any = dict(itertools.islice(result.items(), _MAX_FORMATTED_ITEMS))
+            elif isinstance(result, (set, frozenset)):
+                head = set(itertools.islice(result, _MAX_FORMATTED_ITEMS))
+            else:
+                head = result[:_MAX_FORMATTED_ITEMS]
+            return (
+                pprint.pformat(head, sort_dicts=False) + f"\n... ({len(result)} total)"
+            )
         else:
             return pprint.pformat(result, sort_dicts=False)
 
-    def _do_exec(self, statement):
-        exec(
-            compile(
-                ast.Module(body=[statement], type_ignores=[]),
-                "<string>",
-                "exec",
+    def _compile(self, statement: ast.stmt) -> types.CodeType:
+        """Compile a statement, or reuse the code object of an identical statement that was
+        compiled before (eg before a `reset` or an edit further up the buffer invalidated its
+        result). Expressions are compiled in "eval" mode so that we can get their value.
+
+        A reused code object is moved to the line the statement is at now, so that tracebacks
+        point at the right line of the notebook.
+        """
+
+        fingerprint = self._fingerprint(statement)
+        key = self._fingerprint_hash(statement)
+        try:
+            cached_fingerprint, lineno, code = self._code_cache[key]
+        except KeyError:
+            pass
+        else:
+            if cached_fingerprint is fingerprint or cached_fingerprint == fingerprint:
+                if lineno != statement.lineno:
+                    code = self._relocate(code, statement.lineno - lineno)
+                    self._code_cache[key] = (fingerprint, statement.lineno, code)
+                self._code_cache.move_to_end(key)
+                return code
+
+        if isinstance(statement, ast.Expr):
+            code = compile(ast.Expression(statement.value), "<notebook>", "eval")
+        else:
+            code = compile(
+                ast.Module(body=[statement], type_ignores=[]), "<notebook>", "exec"
+            )
+
+        self._code_cache[key] = (fingerprint, statement.lineno, code)
+        self._code_cache.move_to_end(key)
+        if len(self._code_cache) > _CODE_CACHE_SIZE:
+            self._code_cache.popitem(last=False)
+        return code
+
+    @classmethod
+    def _relocate(cls, code: types.CodeType, offset: int) -> types.CodeType:
+        """Shift the line numbers of a code object, and of the functions, classes etc defined in
+        it, by `offset`. Line numbers are stored relative to `co_firstlineno` so only that needs
+        to change.
+        """
+
+        return code.replace(
+            co_firstlineno=code.co_firstlineno + offset,
+            co_consts=tuple(
+                (
+                    cls._relocate(const, offset)
+                    if isinstance(const, types.CodeType)
+                    else const
+                )
+                for const in code.co_consts
             ),
-            self._globals,
         )
 
     def _remove_popup(self):
+        self._popup_future = None
         try:
             if self._popup_window is not None:
                 self._nvim.api.win_close(self._popup_window, True)
@@ -412,6 +945,14 @@ class BufferNotebook:
         except Exception:
             self._popup_window = None
 
+    def _delete_popup_buffer(self):
+        try:
+            if self._popup_buffer is not None:
+                self._nvim.api.buf_delete(self._popup_buffer, {"force": True})
+                self._popup_buffer = None
+        except Exception:
+            self._popup_buffer = None
+
 
 @pynvim.plugin
 class BufferNotebookPlugin:
@@ -425,17 +966,47 @@ class BufferNotebookPlugin:
             self.notebooks[buffer.number] = BufferNotebook(self.nvim, buffer)
         return self.notebooks[buffer.number]
 
-    @pynvim.autocmd("TextChanged,TextChangedI", pattern="*")
-    def on_change(self, *_):
-        self.get_notebook().on_change()
+    @pynvim.function("BufferNotebookEvaluate", sync=False)
+    def on_change(self, args):
+        (number,) = args
+        try:
+            notebook = self.notebooks[number]
+        except KeyError:
+            pass
+        else:
+            notebook.on_change()
 
-    @pynvim.autocmd("BufDelete", pattern="*")
-    def on_buffer_delete(self, *_):
-        buffer = self.nvim.current.buffer
+    @pynvim.autocmd("BufDelete", pattern="*", eval="expand('<abuf>')")
+    def on_buffer_delete(self, number):
+        # The deleted buffer is not necessarily the current one
         try:
-            del self.notebooks[buffer.number]
+            notebook = self.notebooks.pop(int(number))
         except KeyError:
             pass
+        else:
+            notebook.close()
+
+    @pynvim.rpc_export("nvim_buf_lines_event")
+    def on_buffer_lines(self, buffer, changedtick, firstline, lastline, linedata, more):
+        try:
+            notebook = self.notebooks[buffer.number]
+        except KeyError:
+            pass
+        else:
+            notebook.on_lines(firstline, lastline, linedata)
+
+    @pynvim.rpc_export("nvim_buf_changedtick_event")
+    def on_buffer_changedtick(self, *_):
+        pass
+
+    @pynvim.rpc_export("nvim_buf_detach_event")
+    def on_buffer_detach(self, buffer):
+        try:
+            notebook = self.notebooks[buffer.number]
+        except KeyError:
+            pass
+        else:
+            notebook.on_detach()
 
     @pynvim.autocmd("CursorMoved", pattern="*")
     def on_cursor_moved(self, *_):
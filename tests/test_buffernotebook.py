@@ -1,4 +1,7 @@
 import ast
+import concurrent.futures
+import os
+import pprint
 import sys
 import typing
 from pathlib import Path
@@ -8,7 +11,7 @@ import pytest
 
 sys.path.append(str((Path() / "rplugin" / "python3").resolve()))
 
-from buffernotebook import BufferNotebook, Timer
+from buffernotebook import BufferNotebook, BufferNotebookPlugin, nothing_to_show
 
 
 @pytest.fixture
@@ -18,8 +21,7 @@ def bn():
     buffer = mock.MagicMock(name="buffer")
     bn = BufferNotebook(nvim, buffer)
     yield bn
-    if bn._timer._timer is not None:
-        bn._timer._timer.cancel()
+    bn._executor.shutdown()
 
 
 def test_init(bn):
@@ -27,38 +29,89 @@ def test_init(bn):
     bn._nvim.api.create_namespace.assert_called_once_with("BufferNotebookNamepsace")
     assert bn._globals == {"__name__": "__main__"}
     assert bn._cache == []
-    assert bn._timer._timer is None
+    assert bn._cursor_timer._handle is None
     assert bn._popup_window is None
+    assert bn._popup_buffer is None
 
 
 def test_enable(bn):
-    bn._nvim.api.buf_get_lines.return_value = [""]
-    bn._nvim.api.win_get_cursor.return_value = (1, 0)
+    bn._nvim.api.call_atomic.return_value = [[[""], True], None]
+    bn._nvim.api.win_get_cursor.return_value = [1, 0]
 
     bn.enable()
 
     assert bn._enabled
-    assert isinstance(bn._timer, Timer)
-    bn._nvim.api.buf_get_lines.assert_called_once_with(bn._buffer, 0, -1, False)
+    bn._nvim.api.buf_set_var.assert_called_once_with(
+        bn._buffer, "buffernotebook_enabled", True
+    )
+    bn._nvim.api.call_atomic.assert_called_once_with(
+        [
+            ["nvim_buf_get_lines", [bn._buffer, 0, -1, False]],
+            ["nvim_buf_attach", [bn._buffer, False, {}]],
+        ]
+    )
     bn._nvim.api.win_get_cursor.assert_called_once_with(0)
+    assert bn._lines == [""]
     bn._nvim.out_write.assert_called_once_with("BufferNotebook enabled\n")
 
 
 def test_disable(bn):
-    bn._nvim.api.buf_get_lines.return_value = [""]
-    bn._nvim.api.win_get_cursor.return_value = (1, 0)
+    bn._nvim.api.call_atomic.return_value = [[[""], True], None]
+    bn._nvim.api.win_get_cursor.return_value = [1, 0]
 
     bn.enable()
+    bn.on_cursor_moved()
 
     bn.disable()
 
     assert not bn._enabled
+    bn._nvim.api.buf_set_var.assert_called_with(
+        bn._buffer, "buffernotebook_enabled", False
+    )
+    assert bn._cursor_timer._handle is None
+    assert bn._lines is None
+    bn._nvim.api.buf_detach.assert_called_once_with(bn._buffer)
     bn._nvim.api.buf_clear_namespace.assert_called_once_with(
         bn._buffer, bn._namespace, 0, -1
     )
     assert bn._nvim.out_write.mock_calls[-1] == mock.call("BufferNotebook disabled\n")
 
 
+def test_on_cursor_moved_is_debounced(bn):
+    bn._nvim.api.call_atomic.return_value = [[[""], True], None]
+    bn._nvim.api.win_get_cursor.return_value = [1, 0]
+    bn.enable()
+    bn._nvim.reset_mock()
+
+    bn.on_cursor_moved()
+    bn.on_cursor_moved()
+
+    bn._nvim.api.win_get_cursor.assert_not_called()
+    assert bn._nvim.loop.call_later.mock_calls == [
+        mock.call(0.05, bn._cursor_timer._on_timeout),
+        mock.call().cancel(),
+        mock.call(0.05, bn._cursor_timer._on_timeout),
+    ]
+
+
+def test_on_lines(bn):
+    bn._nvim.api.call_atomic.return_value = [[["a = 1", "b = 2", "c = 3"], True], None]
+    bn._nvim.api.win_get_cursor.return_value = [1, 0]
+    bn.enable()
+    bn._nvim.reset_mock()
+
+    lines = bn._get_lines()
+    assert bn._get_lines() is lines
+
+    bn.on_lines(1, 2, ["b = 20", "bb = 21"])
+    bn.on_lines(0, 1, [])
+
+    assert bn._get_lines() == ("b = 20", "bb = 21", "c = 3")
+    assert lines == ("a = 1", "b = 2", "c = 3")
+    bn._nvim.api.buf_get_lines.assert_not_called()
+    bn._nvim.api.call_atomic.assert_not_called()
+
+
 @pytest.mark.parametrize(
     "argument,expected",
     (
@@ -69,12 +122,52 @@ def test_disable(bn):
             ("This line cannot be parsed", "a = 1", "This line cannot be parsed"),
             ("", "a = 1", ""),
         ),
+        (("if a:", "b = 1"), ("", "b = 1")),
+        (("a = [1", "2]", "b = 2"), ("", "", "b = 2")),
     ),
 )
 def test_remove_unparseable_lines(argument, expected):
     assert BufferNotebook._remove_unparseable_lines(argument) == expected
 
 
+def test_parse_cache(bn):
+    tree = bn._parse(("a = 1", "a + 1  #="))
+
+    assert bn._parse(("a = 1", "a + 1  #=")) is tree
+    assert bn._parse(("a = 2", "a + 1  #=")) is not tree
+
+
+@pytest.mark.parametrize(
+    "before,after",
+    (
+        (("a = 1", "b = 2", "c = 3", "d = 4"), ("a = 1", "b = 2", "c = 30", "d = 4")),
+        (("a = 1", "b = 2", "c = 3"), ("a = 1", "", "x = 0", "b = 2", "c = 3")),
+        (("if a:", "    b = 1", "", "c = 2"), ("if a:", "    b = 1", "else:", "c = 2")),
+        (("a = 1", "b = 2", "c = 3"), ("a = 1", "b = (", "c = 3")),
+        (("a = 1", "b = (", "c = 3", "d = 4"), ("a = 1", "b = (", "c = 3", ")")),
+    ),
+)
+def test_parse_incremental(bn, before, after):
+    bn._parse(before)
+
+    actual = bn._parse(after)
+
+    expected = ast.parse("\n".join(BufferNotebook._remove_unparseable_lines(after)))
+    assert ast.dump(actual, include_attributes=True) == ast.dump(
+        expected, include_attributes=True
+    )
+
+
+def test_parse_incremental_reuses_statements(bn):
+    before = bn._parse(("a = 1", "b = 2", "c = 3", "d = 4", "e = 5")).body
+
+    after = bn._parse(("a = 1", "b = 2", "c = 30", "d = 4", "e = 5")).body
+
+    assert after[0] is before[0]
+    assert after[4] is before[4]
+    assert after[2] is not before[2]
+
+
 class Rest(typing.TypedDict):
     lineno: int
     col_offset: int
@@ -135,11 +228,11 @@ def test_evaluate_statement(bn, stmt, expected):
         assert isinstance(expected, type(actual))
         assert expected.args == actual.args
         assert len(bn._cache) == 1
-        assert bn._cache[0][0] == ast.dump(stmt)
+        assert bn._cache[0][0] == BufferNotebook._fingerprint(stmt)
         assert bn._cache[0][1] == actual
     else:
         assert bn._evaluate_statement(0, stmt) == expected
-        assert bn._cache == [(ast.dump(stmt), expected)]
+        assert bn._cache == [(BufferNotebook._fingerprint(stmt), expected, None)]
 
 
 def test_evaluate_aug_assign(bn):
@@ -157,4 +250,440 @@ def test_evaluate_aug_assign(bn):
     actual = bn._evaluate_statement(1, stmt2)
 
     assert actual == 3
-    assert bn._cache == [(ast.dump(stmt1), 1), (ast.dump(stmt2), 3)]
+    assert bn._cache == [
+        (BufferNotebook._fingerprint(stmt1), 1, None),
+        (BufferNotebook._fingerprint(stmt2), 3, None),
+    ]
+
+
+def test_evaluate_and_annotate(bn):
+    bn._nvim.async_call.side_effect = lambda fn, *args: fn(*args)
+    bn._nvim.api.call_atomic.return_value = [[], None]
+    bn._nvim.api.buf_get_lines.return_value = [
+        "# =",
+        "a = 1  # =",
+        "b = [",
+        "    a,  # =",
+        "]  # <<<",
+        "a + 1",
+        "# <<<",
+    ]
+
+    bn._evaluate_and_annotate()
+    bn._executor.shutdown()
+
+    bn._nvim.api.call_atomic.assert_called_once_with(
+        [
+            ["nvim_buf_clear_namespace", [bn._buffer, bn._namespace, 0, -1]],
+            [
+                "nvim_buf_set_extmark",
+                [bn._buffer, bn._namespace, 1, 0, {"virt_text": [("1", "Info")]}],
+            ],
+            [
+                "nvim_buf_set_extmark",
+                [bn._buffer, bn._namespace, 3, 0, {"virt_text": [("[1]", "Info")]}],
+            ],
+            [
+                "nvim_buf_set_extmark",
+                [bn._buffer, bn._namespace, 4, 0, {"virt_text": [("[1]", "Info")]}],
+            ],
+            [
+                "nvim_buf_set_extmark",
+                [bn._buffer, bn._namespace, 6, 0, {"virt_text": [("2", "Info")]}],
+            ],
+        ]
+    )
+
+
+def test_compile_cache(bn):
+    code = bn._compile(ast.parse("a = 1").body[0])
+
+    assert bn._compile(ast.parse("a  =  1").body[0]) is code
+    assert bn._compile(ast.parse("a = 2").body[0]) is not code
+
+
+def test_evaluate_statement_same_source(bn):
+    lines = ("a = 1", "b = [", "    a", "]")
+    for index, statement in enumerate(ast.parse("\n".join(lines)).body):
+        bn._evaluate_statement(index, statement, lines)
+    statements = ast.parse("\n".join(lines)).body
+
+    assert bn._evaluate_statement(0, statements[0], lines) == 1
+    assert bn._evaluate_statement(1, statements[1], lines) == [1]
+    assert not any(hasattr(statement, "_bn_fingerprint") for statement in statements)
+
+
+def test_evaluate_statement_moved_source(bn):
+    lines = ("a = 1; b = 2",)
+    for index, statement in enumerate(ast.parse("\n".join(lines)).body):
+        bn._evaluate_statement(index, statement, lines)
+
+    # Moved down a line: still the same source, so no fingerprints are needed
+    lines = ("", "a = 1; b = 2")
+    statements = ast.parse("\n".join(lines)).body
+    assert bn._evaluate_statement(0, statements[0], lines) == 1
+    assert bn._evaluate_statement(1, statements[1], lines) == 2
+    assert not any(hasattr(statement, "_bn_fingerprint") for statement in statements)
+
+    # Same line, but a different statement on it
+    lines = ("a = 1", "a = 1; b = 2")
+    statements = ast.parse("\n".join(lines)).body
+    assert bn._evaluate_statement(0, statements[0], lines) == 1
+    assert bn._evaluate_statement(1, statements[1], lines) == 1
+
+
+def test_evaluate_and_annotate_without_marks(bn):
+    bn._nvim.async_call.side_effect = lambda fn, *args: fn(*args)
+    bn._nvim.api.call_atomic.return_value = [[], None]
+    bn._nvim.api.buf_get_lines.return_value = ["a = 1", "a + 1"]
+
+    bn._evaluate_and_annotate()
+    bn._executor.shutdown()
+
+    bn._nvim.api.call_atomic.assert_called_once_with(
+        [["nvim_buf_clear_namespace", [bn._buffer, bn._namespace, 0, -1]]]
+    )
+    assert bn._cache == []
+
+
+@pytest.mark.parametrize(
+    "result", (list(range(1000)), dict.fromkeys(range(1000)), set(range(1000)))
+)
+def test_format_multiline_result_truncates(bn, result):
+    lines = bn._format_multiline_result(result).splitlines()
+
+    assert len(lines) == 201
+    assert lines[-1] == "... (1000 total)"
+
+
+def test_flush_annotations_ignores_stale_results(bn):
+    future: concurrent.futures.Future = concurrent.futures.Future()
+    future.set_result([(0, "1")])
+
+    bn._flush_annotations(future, ())
+
+    bn._nvim.api.call_atomic.assert_not_called()
+
+
+def test_evaluate_expression_without_compiling(bn):
+    statements = ast.parse("import os\nos.path.sep\nlen").body
+    bn._evaluate_statement(0, statements[0])
+
+    assert bn._evaluate_statement(1, statements[1]) == os.path.sep
+    assert len(bn._code_cache) == 1
+    assert bn._evaluate_statement(2, statements[2]) is len
+
+
+def test_evaluate_until(bn):
+    lines = ("a = 1", "b = [", "    a,", "]", "", "a + 1")
+
+    assert bn._evaluate_until(lines, 2) == ([1], bn._parse(lines).body[1])
+    assert bn._evaluate_until(lines, 4) == (nothing_to_show, None)
+    with mock.patch.object(bn, "_evaluate_statement") as evaluate_statement:
+        assert bn._evaluate_until(lines, 0)[0] == 1
+    evaluate_statement.assert_not_called()
+    assert bn._evaluate_until(lines, 5)[0] == 2
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        ("a  #=", True),
+        ("a  # = ", True),
+        ("a  # <<<", True),
+        ("a  #<<<\t", True),
+        ("a = 1", False),
+        ("a == b", False),
+        ("a += 1  # =>", False),
+        ("# <<< a", False),
+        ("", False),
+    ],
+)
+def test_has_mark(line, expected):
+    assert BufferNotebook._has_mark(line) is expected
+
+
+def test_evaluate_marks_gives_up_when_stale(bn):
+    lines = ("a = 1  #=", "b = 2  #=")
+
+    bn._generation = 1
+    assert bn._evaluate_marks(lines, 0) == []
+    assert bn._cache == []
+
+    assert bn._evaluate_marks(lines, 1) == [(0, "1"), (1, "2")]
+
+
+def test_evaluate_and_annotate_skips_unchanged_text(bn):
+    bn._nvim.api.buf_get_lines.return_value = ["a = 1  #="]
+
+    with mock.patch.object(bn._executor, "submit") as submit:
+        bn._evaluate_and_annotate()
+        bn._evaluate_and_annotate()
+        assert submit.call_count == 1
+
+        bn._nvim.api.buf_get_lines.return_value = ["a = 2  #="]
+        bn._evaluate_and_annotate()
+        assert submit.call_count == 2
+
+        bn.reset()
+        assert submit.call_args.args[0] == bn._evaluate_marks
+        assert submit.call_count == 4
+
+
+def test_open_popup(bn):
+    bn._nvim.async_call.side_effect = lambda fn, *args: fn(*args)
+    bn._nvim.api.call_atomic.return_value = [[["a = list(range(30))  #="], True], None]
+    bn._nvim.api.win_get_cursor.return_value = [1, 4]
+    bn._enabled = True
+
+    bn._open_popup()
+    bn._executor.shutdown()
+
+    popup_lines = pprint.pformat(list(range(30))).splitlines()
+    bn._nvim.api.buf_set_lines.assert_called_once_with(
+        bn._nvim.api.create_buf.return_value, 0, -1, False, popup_lines
+    )
+    assert bn._nvim.api.open_win.call_args.args[2]["height"] == len(popup_lines)
+    assert bn._popup_window is bn._nvim.api.open_win.return_value
+    bn._nvim.api.buf_set_var.assert_called_once_with(
+        bn._buffer, "buffernotebook_popup", bn._popup_window.handle
+    )
+
+
+def test_open_popup_after_cursor_moved(bn):
+    bn._nvim.api.call_atomic.return_value = [[["a = list(range(30))  #="], True], None]
+    bn._nvim.api.win_get_cursor.return_value = [1, 4]
+    bn._enabled = True
+
+    bn._open_popup()
+    bn.on_cursor_moved()
+    bn._executor.shutdown()
+    show_popup, future, column = bn._nvim.async_call.call_args.args
+    show_popup(future, column)
+
+    bn._nvim.api.open_win.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (ValueError("a"), "! ValueError('a')"),
+        ([1, 2], "[1, 2]"),
+        (list(range(20_000)), "<list len=20000>"),
+        ("a" * 20_000, "<str len=20000>"),
+    ],
+)
+def test_annotation(value, expected):
+    assert BufferNotebook._annotation(value) == expected
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("a, b = 1, 2", (1, 2)),
+        ("a, b[0] = 1, [2]", nothing_to_show),
+        ("import os, sys", (os, sys)),
+        ("import os.path", nothing_to_show),
+    ],
+)
+def test_evaluate_statement_names(bn, source, expected):
+    bn._globals["b"] = [None]
+    assert bn._evaluate_statement(0, ast.parse(source).body[0]) == expected
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("a\nb", "a\nb"),
+        (1, "1"),
+        (None, "None"),
+        (ValueError("a"), "! ValueError('a')"),
+        ({"a": 1}, "{'a': 1}"),
+    ],
+)
+def test_format_multiline_result(bn, value, expected):
+    assert bn._format_multiline_result(value) == expected
+
+
+def test_popup_buffer_is_reused(bn):
+    bn._nvim.async_call.side_effect = lambda fn, *args: fn(*args)
+    bn._nvim.api.call_atomic.return_value = [[["a = list(range(30))  #="], True], None]
+    bn._nvim.api.win_get_cursor.return_value = [1, 4]
+    bn._enabled = True
+
+    for _ in range(2):
+        bn._open_popup()
+        bn._executor.submit(lambda: None).result()
+        bn.on_cursor_moved()
+
+    bn._nvim.api.create_buf.assert_called_once_with(False, True)
+    assert bn._nvim.api.open_win.call_count == 2
+    assert bn._nvim.api.win_close.call_count == 2
+
+    bn.close()
+
+    bn._nvim.api.buf_delete.assert_called_once_with(
+        bn._nvim.api.create_buf.return_value, {"force": True}
+    )
+    assert bn._popup_buffer is None
+
+
+def test_on_change(bn):
+    bn._nvim.api.call_atomic.return_value = [[["a = 1"], True], None]
+    bn._nvim.api.win_get_cursor.return_value = [1, 0]
+    bn.enable()
+
+    with mock.patch.object(bn._executor, "submit") as submit:
+        bn.on_lines(0, 1, ["a = 2  #="])
+        bn.on_change()
+
+    submit.assert_called_once_with(bn._evaluate_marks, ("a = 2  #=",), bn._generation)
+
+
+@pytest.mark.parametrize(
+    "source, other, equal",
+    [
+        ("a = [1, 2]", "a = [\n    1,\n    2,\n]  # comment", True),
+        ("a = 1", "a = True", False),
+        ("a = 1", "a = 1.0", False),
+        ("a = b", "a = 'b'", False),
+    ],
+)
+def test_fingerprint(source, other, equal):
+    assert (
+        BufferNotebook._fingerprint(ast.parse(source).body[0])
+        == BufferNotebook._fingerprint(ast.parse(other).body[0])
+    ) is equal
+
+
+def test_evaluate_marks_same_statements(bn):
+    bn._evaluate_marks(("a = [1]  #=", "a.append(2)", "a  #="), bn._generation)
+
+    with mock.patch.object(bn, "_evaluate_statement") as evaluate_statement:
+        assert bn._evaluate_marks(
+            ("a = [1]  #= ", "a.append(2)  # comment", "a  #="), bn._generation
+        ) == [(0, "[1]"), (2, "[1, 2]")]
+    evaluate_statement.assert_not_called()
+
+    assert bn._evaluate_marks(("a = [1]", "a.append(2)", "a  #="), bn._generation) == [
+        (2, "[1, 2]")
+    ]
+
+
+def test_evaluate_marks_skips_unchanged_statements(bn):
+    bn._evaluate_marks(("a = 1", "b = a + 1  #=", "c = b + 1  #="), bn._generation)
+
+    with mock.patch.object(
+        bn, "_evaluate_statement", wraps=bn._evaluate_statement
+    ) as evaluate_statement:
+        assert bn._evaluate_marks(
+            ("a = 1", "b = a + 1  #=", "c = b + 2  #="), bn._generation
+        ) == [(1, "2"), (2, "4")]
+    assert [c.args[0] for c in evaluate_statement.mock_calls] == [2]
+
+
+def test_fingerprint_ignores_location(bn):
+    statement = ast.parse("a = 1").body[0]
+    moved = ast.parse("a = 1").body[0]
+    ast.increment_lineno(moved, 10)
+    moved.col_offset += 4
+
+    assert BufferNotebook._fingerprint(moved) == BufferNotebook._fingerprint(statement)
+
+    assert bn._evaluate_statement(0, statement) == 1
+    bn._globals["a"] = 2
+    assert bn._evaluate_statement(0, moved) == 1
+
+
+def test_evaluate_marks_delete_and_undo(bn):
+    lines = ("a = 1  #=", "a += 1  #=")
+    assert bn._evaluate_marks(lines, bn._generation) == [(0, "1"), (1, "2")]
+
+    for _ in range(2):
+        bn._evaluate_marks(lines[:1], bn._generation)
+        assert bn._evaluate_marks(lines, bn._generation) == [(0, "1"), (1, "2")]
+
+
+def test_find_marks():
+    lines = ("a = 1  #=", "a", "", "b = [", "    a,  # <<< ", "]  # =", "# <<< b", "#=")
+    assert BufferNotebook._find_marks(lines) == [0, 4, 5, 7]
+    assert BufferNotebook._find_marks(lines) == [
+        index for index, line in enumerate(lines) if BufferNotebook._has_mark(line)
+    ]
+
+
+def test_close_ignores_running_evaluation(bn):
+    future = concurrent.futures.Future()
+    bn._future = future
+
+    bn.close()
+    future.set_result([(0, "1")])
+    bn._flush_annotations(future, ())
+
+    bn._nvim.api.call_atomic.assert_not_called()
+
+
+def test_on_buffer_delete():
+    nvim = mock.MagicMock(name="nvim")
+    plugin = BufferNotebookPlugin(nvim)
+    deleted, current = mock.MagicMock(name="deleted"), mock.MagicMock(name="current")
+    plugin.notebooks = {3: deleted, 5: current}
+    nvim.current.buffer.number = 5
+
+    plugin.on_buffer_delete("3")
+
+    deleted.close.assert_called_once_with()
+    current.close.assert_not_called()
+    assert plugin.notebooks == {5: current}
+
+
+def test_compile_cache_key(bn):
+    statement = ast.parse("a = [1, 2]").body[0]
+    code = bn._compile(statement)
+
+    fingerprint = BufferNotebook._fingerprint(statement)
+    assert bn._code_cache == {hash(fingerprint): (fingerprint, 1, code)}
+    assert bn._compile(ast.parse("a = [1,  2]  # same").body[0]) is code
+
+    # A different statement whose fingerprint happens to have the same hash
+    other = ast.parse("a = [3]").body[0]
+    BufferNotebook._fingerprint(other)
+    setattr(other, "_bn_fingerprint_hash", hash(fingerprint))
+    other_code = bn._compile(other)
+    assert other_code is not code
+    namespace: dict = {}
+    exec(other_code, namespace)
+    assert namespace["a"] == [3]
+
+
+def test_compile_cache_moved_statement(bn):
+    code = bn._compile(ast.parse("x = 1 / 0").body[0])
+    moved = bn._compile(ast.parse("\n\n\nx = 1 / 0").body[0])
+
+    assert moved is not code
+    with pytest.raises(ZeroDivisionError) as exc_info:
+        exec(moved, {})
+    assert exc_info.tb.tb_next.tb_lineno == 4
+
+    # Functions defined by the statement move along with it
+    bn._compile(ast.parse("def f():\n    return 1 / 0").body[0])
+    namespace: dict = {}
+    exec(bn._compile(ast.parse("\n\ndef f():\n    return 1 / 0").body[0]), namespace)
+    with pytest.raises(ZeroDivisionError) as exc_info:
+        namespace["f"]()
+    assert exc_info.tb.tb_next.tb_lineno == 4
+
+
+def test_flush_annotations_after_buffer_changed(bn):
+    lines = ("a = 1  #=", "a  #=", "a  #=", "a  #=")
+    bn._nvim.api.call_atomic.return_value = [[list(lines), True], None]
+    bn._enabled = True
+    assert bn._get_lines() == lines
+
+    future = bn._future = bn._executor.submit(bn._evaluate_marks, lines, 0)
+    future.result()
+    bn.on_lines(1, 4, [])
+    bn._nvim.api.call_atomic.reset_mock()
+    bn._flush_annotations(future, lines)
+
+    bn._nvim.api.call_atomic.assert_not_called()
@@ -1,32 +1,42 @@
+import asyncio
 import time
 
 import pytest
 from buffernotebook import Timer
 
 
-def test_simple():
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_simple(loop):
     count = 0
 
     def callback():
         nonlocal count
         count += 1
 
-    t = Timer(callback, 0.1)
+    t = Timer(callback, loop, 0.1)
     t.event()
     assert count == 0
-    time.sleep(0.2)
+    loop.run_until_complete(asyncio.sleep(0.2))
     assert count == 1
 
 
 @pytest.mark.parametrize(
     "timer_delay,callback_duration,second_event_delay,expected_count",
     (
-        (0.2, 0.1, 0.1, 1),  # second event in timer
-        (0.2, 0.1, 0.3, 2),  # second event in callback, timer finishes after callback
-        (0.2, 0.3, 0.3, 2),  # second event in callback, timer finishes before callback
+        (0.2, 0.1, 0.1, 1),  # second event while the timer is pending: coalesced
+        (0.2, 0.1, 0.3, 2),  # second event after the callback has finished
+        (0.2, 0.3, 0.3, 2),  # second event due during the callback: delivered after it
     ),
 )
-def test_complex(timer_delay, callback_duration, second_event_delay, expected_count):
+def test_complex(
+    loop, timer_delay, callback_duration, second_event_delay, expected_count
+):
     count = 0
 
     def callback():
@@ -34,9 +44,57 @@ def test_complex(timer_delay, callback_duration, second_event_delay, expected_co
         time.sleep(callback_duration)
         count += 1
 
-    t = Timer(callback, timer_delay)
+    t = Timer(callback, loop, timer_delay)
     t.event()
-    time.sleep(second_event_delay)
-    t.event()
-    time.sleep(timer_delay + callback_duration + 0.1)
+    loop.call_later(second_event_delay, t.event)
+    loop.run_until_complete(
+        asyncio.sleep(second_event_delay + timer_delay + callback_duration + 0.1)
+    )
     assert count == expected_count
+
+
+def test_timeout_while_executing(loop):
+    # A callback that yields back to the loop can have the next timer finish while it is still
+    # running; the callback then runs again once it has finished, instead of nested in itself
+    calls = []
+
+    def callback():
+        calls.append("start")
+        if len(calls) == 1:
+            t._on_timeout()
+        calls.append("finish")
+
+    t = Timer(callback, loop, 0.1)
+    t.event()
+    loop.run_until_complete(asyncio.sleep(0.2))
+    assert calls == ["start", "finish", "start", "finish"]
+
+
+def test_cancel_while_executing(loop):
+    count = 0
+
+    def callback():
+        nonlocal count
+        count += 1
+        if count == 1:
+            t._on_timeout()
+            t.cancel()
+
+    t = Timer(callback, loop, 0.1)
+    t.event()
+    loop.run_until_complete(asyncio.sleep(0.2))
+    assert count == 1
+
+
+def test_cancel(loop):
+    count = 0
+
+    def callback():
+        nonlocal count
+        count += 1
+
+    t = Timer(callback, loop, 0.1)
+    t.event()
+    t.cancel()
+    loop.run_until_complete(asyncio.sleep(0.2))
+    assert count == 0